@@ -0,0 +1,47 @@
+# cython: language_level=3
+"""A compiled parser for BSPWM reports, used by the `BSPWM` example module.
+
+Build it in place (from this directory) with:
+    cythonize -i _bspwm_parse.pyx
+
+If it isn't built, the example falls back to the pure Python parser. Desktops
+are returned in a plain `dict`, so this relies on Python 3.7+ preserving
+insertion order.
+"""
+
+
+cpdef dict parse_event(str event, str monitor):
+    """Parse a BSPWM event.
+
+    Parameters:
+        event (str): The BSPWM event.
+        monitor (str): The name of the monitor to get the desktops for.
+
+    Returns:
+        dict: Keys are desktop names, values are the status.
+    """
+    cdef dict desktops = {}
+    cdef bint on_monitor = False
+    cdef Py_ssize_t i, start = 0, length
+    cdef Py_UCS4 tag
+
+    length = len(event)
+    if length and event[0] == 'W':
+        start = 1
+
+    while start < length:
+        # Find the end of this item
+        i = start
+        while i < length and event[i] != ':':
+            i += 1
+
+        if i > start:
+            tag = event[start]
+            if tag == 'M' or tag == 'm':
+                on_monitor = event[start+1:i] == monitor
+            elif on_monitor and tag in 'OoFfUu':
+                desktops[event[start+1:i]] = tag
+
+        start = i + 1
+
+    return desktops
@@ -1,10 +1,20 @@
-from collections import OrderedDict
-import re
 import subprocess as sp
 from time import time, strftime
 
+import alsaaudio
+
 from lemonbar_manager import Module, Manager
 
+try:  # The compiled BSPWM parser is optional, see `_bspwm_parse.pyx`
+    from _bspwm_parse import parse_event as _parse_bspwm_event
+except ImportError:
+    _parse_bspwm_event = None
+
+
+# BSPWM report tags, for monitors and desktops respectively
+_MONITOR_TAGS = frozenset('Mm')
+_DESKTOP_TAGS = frozenset('OoFfUu')
+
 
 class Const(Module):
     def __init__(self, value):
@@ -14,6 +24,8 @@ class Const(Module):
             value (str): The value to output to the bar.
         """
         super().__init__()
+        self.event_prefixes = ()  # We don't handle any events
+        self.wait_time = 86400  # Our output never changes
         self._value = value
 
     def output(self):
@@ -33,9 +45,13 @@ class Launcher(Module):
         self._label = label
         self._command = command
         self._event_name = '{}_click'.format(self._label)
+        self.event_prefixes = (self._event_name,)
+        self.wait_time = 86400  # Our output never changes
+
+        self._rendered = '%{A:' + self._event_name + ':}' + label + '%{A}'
 
     def output(self):
-        return '%{A:' + self._event_name + ':}' + self._label + '%{A}'
+        return self._rendered
 
     def handle_event(self, event):
         """Handle out click event.
@@ -58,24 +74,41 @@ class Clock(Module):
         """
         super().__init__()
         self.wait_time = 60  # How often to update this module
+        self.event_prefixes = ('toggle_clock',)
         self._toggled_at = 0  # When the clock was toggled
 
-    def output(self):
+        self._time_prefix = '%{A:toggle_clock:}\uf150 '.encode('utf-8')
+        self._date_prefix = '%{A:toggle_clock:}\uf0ee '.encode('utf-8')
+        self._suffix = b'%{A}'
+
+        # The formatted text only changes once a minute, so cache it along with
+        # the minute (and format) it was generated for
+        self._cache_key = None
+        self._cached_text = b''
+
+    def render(self):
+        now = time()
+
         # If the clock has been toggled for more than a certain period of time
-        if self._toggled_at and time() - self._toggled_at > 5:
+        if self._toggled_at and now - self._toggled_at > 5:
             self._toggled_at = None  # Automatically toggle back to the clock
 
-        if self._toggled_at:
-            return '%{A:toggle_clock:}\uf0ee ' + strftime('%d/%m/%Y') + '%{A}'
-        else:
-            return '%{A:toggle_clock:}\uf150 ' + strftime('%H:%M') + '%{A}'
+        fmt = '%d/%m/%Y' if self._toggled_at else '%H:%M'
+        key = (int(now // 60), fmt)
+        if key != self._cache_key:
+            self._cached_text = strftime(fmt).encode('utf-8')
+            self._cache_key = key
+
+        yield self._date_prefix if self._toggled_at else self._time_prefix
+        yield self._cached_text
+        yield self._suffix
 
     def handle_event(self, event):
         if event != 'toggle_clock':
             return
 
         self._toggled_at = None if self._toggled_at else time()
-        self.last_update = 0  # Invalidate the cache
+        self.invalidate()
 
 
 class Volume(Module):
@@ -87,38 +120,37 @@ class Volume(Module):
         """
         super().__init__()
         self._device = device
+        self._event_prefix = 'set_volume_{}_'.format(device)
+        self._prefix_len = len(self._event_prefix)
+        self.event_prefixes = (self._event_prefix,)
 
-        self._regex = re.compile(r'(\d{1,3})%')  # For parsing ALSA output
-        self._increments = 20  # The resolution of our volume control
+        # Talk to ALSA directly and redraw whenever the mixer reports a change,
+        # so the bar also follows volume changes made by other programs
+        self._mixer = alsaaudio.Mixer(device)
+        self.readables = [fd for fd, _ in self._mixer.polldescriptors()]
 
-        self._current_level = self._get_level()
-
-    def _parse_amixer(self, data):
-        """Parse the output from the amixer command.
+        self._increments = 20  # The resolution of our volume control
 
-        Parameters::
-            data (str): The output from amixer.
-
-        Returns:
-            int: An integer between 0 and 100 (inclusive) representing the
-                volume level.
-        """
-        levels = [int(level) for level in re.findall(self._regex, data)]
-        return sum(levels) / (len(levels) * 100)
+        # Pre-build the clickable segments of the bar, only the level changes
+        self._prefix = '\uF57F'
+        self._suffix = ' \uF57E'
+        self._on_segments = [
+            '%{{A:set_volume_{}_{}:}}--%{{A}}'.format(device, i)
+            for i in range(self._increments + 1)]
+        self._off_segments = [
+            '%{{A:set_volume_{}_{}:}}  %{{A}}'.format(device, i)
+            for i in range(self._increments + 1)]
+        self._outputs = {}  # Encoded output, keyed by the number of segments
 
     def _get_level(self):
         """Get the current volume level for the device.
 
         Returns:
-            int: An integer between 0 and 100 (inclusive) representing the
+            float: A number between 0 and 1 (inclusive) representing the
                 volume level.
         """
-        process = sp.run(
-            ['amixer', 'get', self._device],
-            stdout=sp.PIPE,
-            encoding='UTF-8')
-
-        return self._parse_amixer(process.stdout)
+        levels = self._mixer.getvolume()
+        return sum(levels) / (len(levels) * 100)
 
     def _set_level(self, percent):
         """Set the volume level for the device.
@@ -126,37 +158,31 @@ class Volume(Module):
         Parameters:
             percent (int): An integer between 0 and 100 (inclusive).
         """
-        process = sp.run(
-            ['amixer', 'set', 'Master', '{:.0f}%'.format(percent)],
-            stdout=sp.PIPE,
-            encoding='UTF-8')
+        self._mixer.setvolume(int(round(percent)))
 
-    def output(self):
-        output = ['\uF57F']
-        for i in range(self._increments + 1):
-            output.append('%{{A:set_volume_{}_{}:}}'.format(self._device, i))
+    def render(self):
+        self._mixer.handleevents()  # Acknowledge any pending mixer events
+        filled = round(self._increments*self._get_level())
 
-            if round(self._increments*self._current_level) >= i:
-                output.append('--')
-            else:
-                output.append('  ')
+        output = self._outputs.get(filled)
+        if output is None:
+            output = (
+                self._prefix +
+                ''.join(self._on_segments[:filled+1]) +
+                ''.join(self._off_segments[filled+1:]) +
+                self._suffix).encode('utf-8')
+            self._outputs[filled] = output
 
-            output.append('%{A}')
-
-        output.append(' \uF57E')
-
-        return ''.join(output)
+        yield output
 
     def handle_event(self, event):
-        if not event.startswith('set_volume_{}_'.format(self._device)):
+        if not event.startswith(self._event_prefix):
             return
 
-        level = int(event[event.rindex('_')+1:])
-        percent = (level / self._increments) * 100
+        level = int(event[self._prefix_len:]) / self._increments
 
-        self._set_level(percent)
-        self._current_level = percent
-        self.last_update = 0  # Invalidate the cache to force a redraw
+        self._set_level(level * 100)
+        self.invalidate()  # Force a redraw
 
 
 class BSPWM(Module):
@@ -176,6 +202,12 @@ class BSPWM(Module):
         self.readables = [self._subscription_process.stdout]
 
         self._monitor = monitor
+        if _parse_bspwm_event is not None:  # Prefer the compiled parser
+            self._parse_event = lambda event: _parse_bspwm_event(event, monitor)
+
+        self._event_prefix = 'focus_desktop_'
+        self._prefix_len = len(self._event_prefix)
+        self.event_prefixes = (self._event_prefix,)
 
         # The different format strings use to display the stauts of the desktops
         self._formats = {
@@ -188,6 +220,9 @@ class BSPWM(Module):
             'u': '%{{B#F00}}  {}  %{{B-}}',  # Unfocused, Urgent
         }
 
+        # Fully wrapped, encoded desktop segments, keyed by (desktop, state)
+        self._segments = {}
+
     def _parse_event(self, event):
         """Parse a BSPWM event.
 
@@ -195,43 +230,52 @@ class BSPWM(Module):
             event (str): The BSPWM event.
 
         Returns:
-            OrderedDict: Keys are desktop names, values are the status.
+            dict: Keys are desktop names (in the order reported), values are
+                the status.
         """
-        desktops = OrderedDict()
+        desktops = {}
 
-        event = event.lstrip('W')
+        if event[:1] == 'W':  # Only copy the event if there's a prefix to drop
+            event = event[1:]
         items = event.split(':')
 
         on_monitor = False
 
         for item in items:
+            if not item:  # e.g. a trailing `:`, or an empty read at EOF
+                continue
+
             k, v = item[0], item[1:]
 
-            if k in 'Mm':
+            if k in _MONITOR_TAGS:
                 on_monitor = v == self._monitor
-            elif on_monitor and k in 'OoFfUu':
+            elif on_monitor and k in _DESKTOP_TAGS:
                 desktops[v] = k
 
         return desktops
 
-    def output(self):
+    def render(self):
         event = self.readables[0].readline().strip()
 
         desktops = self._parse_event(event)
 
-        output = []
-        for desktop, state in desktops.items():
-            output.append('%{{A:focus_desktop_{}:}}'.format(desktop))
-            output.append(self._formats[state].format(desktop))
-            output.append('%{A}')
+        for key in desktops.items():
+            segment = self._segments.get(key)
+            if segment is None:
+                desktop, state = key
+                segment = (
+                    '%{A:focus_desktop_' + desktop + ':}' +
+                    self._formats[state].format(desktop) +
+                    '%{A}').encode('utf-8')
+                self._segments[key] = segment
 
-        return ''.join(output)
+            yield segment
 
     def handle_event(self, event):
-        if not event.startswith('focus_desktop_'):
+        if not event.startswith(self._event_prefix):
             return
 
-        desktop = event[event.rindex('_')+1:]
+        desktop = event[self._prefix_len:]
         sp.Popen(['bspc', 'desktop', '--focus', '{}.local'.format(desktop)])
 
 
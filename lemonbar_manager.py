@@ -1,7 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 import io
 import logging
+import os
+import selectors
 import subprocess as sp
 from select import select
+import signal
+import threading
 import time
 
 
@@ -12,19 +18,48 @@ class Module:
     def __init__(self):
         """The base class each module should inherit from.
 
-        You should override either `self.readable` or `self.wait_time`.
+        You should override either `self.readable` or `self.wait_time`, and
+        either `self.output` or `self.render`.
 
         If you want to wait for one or more files handle to become readable, set
         `self.readables` to a list of file handles.
 
         If you want to update regularly (time based), set `self.wait_time` to
         the interval (in seconds) to waid between updates.
+
+        If the module only handles certain events, set `self.event_prefixes` to
+        a tuple of the prefixes of the event names it handles (an empty tuple
+        means it handles none). By default a module receives every event.
         """
         self.readables = []
         self.wait_time = 86400  # Default, 1 day
+        self.event_prefixes = None  # Receive all events
+        self._manager = None  # Set by the `Manager` running this module
         self.last_update = 0
         self.cache = None
 
+    @property
+    def last_update(self):
+        """float: When the module was last updated, `0` if it needs updating.
+        """
+        return self._last_update
+
+    @last_update.setter
+    def last_update(self, value):
+        self._last_update = value
+
+        # Setting this to 0 is how modules have always requested a redraw
+        if value == 0 and getattr(self, '_manager', None) is not None:
+            self._manager._invalidate(self)
+
+    def invalidate(self):
+        """Invalidate the cached output, forcing a redraw on the next loop.
+
+        Call this when the module's output has changed, e.g. in response to an
+        event. It's equivalent to setting `self.last_update` to `0`.
+        """
+        self.last_update = 0
+
     def select(self):
         """Get the readables from `self.readables` that are currently readable.
 
@@ -37,8 +72,9 @@ class Module:
     def handle_event(self, event):
         """This will be called when events are fired.
 
-        This recieved events from ALL modules, so you need to check the `event`
-        parameter to ensure it's the event you want to handle.
+        Unless `self.event_prefixes` is set, this recieved events from ALL
+        modules, so you need to check the `event` parameter to ensure it's the
+        event you want to handle.
 
         Parameters:
             event (str): The name of the event that was fired.
@@ -50,17 +86,34 @@ class Module:
         This is what will be output onto the bar.
 
         Returns:
-            str: The data to send to the bar.
+            str: The data to send to the bar. `bytes` (UTF-8 encoded) may be
+                returned instead to avoid re-encoding unchanged output.
         """
         return ''
 
+    def render(self):
+        """Generate the module's output as UTF-8 encoded fragments.
+
+        By default this yields the encoded value returned by `self.output`.
+        Override it to yield pre-encoded fragments. When this is the only
+        module being updated, its fragments are copied straight into the line
+        being built for the bar; otherwise it's rendered on a worker thread
+        into a buffer of its own, which is then copied into the line.
+
+        Yields:
+            bytes: The next fragment of output.
+        """
+        value = self.output()
+        yield value.encode('utf-8') if isinstance(value, str) else value
+
 
 class Manager:
     def __init__(self, args, modules):
         """Run lemonbar with the specified modules.
 
-        The process is launched with the input piped and with the correct
-        encoding automatically set.
+        The process is launched with its input and output piped. The pipes are
+        binary, modules render UTF-8 encoded fragments that are assembled into
+        a single line for the bar.
 
         Parameters:
             args (list): The full command used to launch lemonbar.
@@ -70,11 +123,93 @@ class Manager:
             subprocess.Popen: An object representing the lemonbar process.
         """
         LOGGER.debug('Starting Process')
-        self._lemonbar = sp.Popen(
-            args, stdin=sp.PIPE, stdout=sp.PIPE, encoding='UTF-8')
+        self._lemonbar = sp.Popen(args, stdin=sp.PIPE, stdout=sp.PIPE)
+
+        # A self-pipe, written to by signal handlers to wake up the main loop
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
 
         self._modules = modules
 
+        # Map modules and their readables back to their positions on the bar
+        self._positions = {}
+        self._readable_positions = {}
+        for index, module in enumerate(self._modules):
+            module._manager = self
+            self._positions.setdefault(module, []).append(index)
+            for readable in module.readables:
+                self._readable_positions.setdefault(readable, []).append(index)
+
+        # Event handlers, keyed by the event prefix they handle. Modules without
+        # any prefixes declared are sent every event.
+        self._handlers = {}
+        self._broadcast_handlers = []
+        for module in self._modules:
+            if module.event_prefixes is None:
+                if module not in self._broadcast_handlers:
+                    self._broadcast_handlers.append(module)
+                continue
+
+            for prefix in module.event_prefixes:
+                handlers = self._handlers.setdefault(prefix, [])
+                if module not in handlers:
+                    handlers.append(module)
+
+        self._prefix_lengths = sorted(
+            {len(prefix) for prefix in self._handlers})
+
+        # The last (encoded) output of each module, in bar order
+        self._parts = [b''] * len(self._modules)
+        self._last_line = None  # The last line sent to lemonbar
+
+        # A min-heap of `(next_update, index)` pairs. Entries aren't removed
+        # when a module is rescheduled, so any entry that doesn't match
+        # `self._next_update` is stale and is skipped. The heap is compacted
+        # whenever stale entries could outnumber the live ones.
+        self._schedule = []
+        self._next_update = [None] * len(self._modules)
+        for index, module in enumerate(self._modules):
+            if module.wait_time:
+                self._reschedule(index, 0)  # Draw everything straight away
+
+        # Used to render several modules at once, see `self._run_modules`
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(self._modules)))
+
+        # Everything we wait on is registered once, up front. We wait for
+        # events coming from lemonbar and signals asking us to stop too.
+        readables = list(self._readable_positions)
+        readables.extend([self._lemonbar.stdout, self._wake_r])
+        try:
+            self._selector = self._make_selector(
+                selectors.DefaultSelector, readables)
+        except PermissionError:
+            # epoll refuses regular files, fall back to `select` which (like
+            # before) treats them as always readable
+            LOGGER.info('Falling back to select for a readable epoll refused')
+            self._selector = self._make_selector(
+                selectors.SelectSelector, readables)
+
+    def _make_selector(self, selector_class, readables):
+        """Create a selector waiting for `readables` to become readable.
+
+        Parameters:
+            selector_class (type): The `selectors.BaseSelector` to create.
+            readables (list): The readables to register.
+
+        Returns:
+            selectors.BaseSelector: The selector, with `readables` registered.
+        """
+        selector = selector_class()
+        try:
+            for readable in readables:
+                selector.register(readable, selectors.EVENT_READ)
+        except Exception:
+            selector.close()
+            raise
+
+        return selector
+
     def __enter__(self):
         LOGGER.debug('Entering context manager')
         return self
@@ -82,128 +217,223 @@ class Manager:
     def __exit__(self, *args, **kwargs):
         LOGGER.debug('Killing process and exiting context manager')
         self._lemonbar.kill()
+        self._selector.close()
+        self._pool.shutdown(wait=False)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _handle_signal(self, signum, frame):
+        """Wake up the main loop so it can shut down cleanly.
+
+        Parameters:
+            signum (int): The signal that was received.
+            frame (frame): The interrupted stack frame.
+        """
+        try:
+            os.write(self._wake_w, b'x')
+        except BlockingIOError:
+            pass  # The pipe is full, so the loop will be woken anyway
 
-    def _wait(self, rlist, wait_time):
-        """Wait until an object in `rlist` is readable or `wait_time` is up.
+    def _wait(self, wait_time):
+        """Wait until a registered readable is readable or `wait_time` is up.
 
         Parameter:
-            rlist (list): A list of readables for `select` to monitor.
             wait_time (float): The maximum amount of time to wait.
 
         Returns:
             list: A list of readables that are ready to read.
         """
-        early_execution = False
-
-        LOGGER.info('Waiting {} seconds'.format(wait_time))
+        LOGGER.info('Waiting %s seconds', wait_time)
 
-        if len(rlist) > 0:
-            readables, _, _ = select(rlist, [], [], wait_time)
-            LOGGER.info('{} readables ready for reading'.format(len(readables)))
-        else:
-            LOGGER.info('There are no readables to wait for')
-            readables = []
-            time.sleep(wait_time)
+        readables = [key.fileobj for key, _ in self._selector.select(wait_time)]
+        LOGGER.info('%d readables ready for reading', len(readables))
 
         return readables
 
+    def _reschedule(self, index, when):
+        """Schedule the module at `index` to be updated at `when`.
+
+        Parameters:
+            index (int): The position of the module on the bar.
+            when (float): The time at which the module should next be updated.
+        """
+        self._next_update[index] = when
+        heapq.heappush(self._schedule, (when, index))
+
+        if len(self._schedule) > 2 * len(self._modules):
+            self._schedule = [
+                (when, index) for index, when in enumerate(self._next_update)
+                if when is not None]
+            heapq.heapify(self._schedule)
+
+    def _invalidate(self, module):
+        """Schedule `module` to be updated immediately.
+
+        Parameters:
+            module (Module): The module that was invalidated.
+        """
+        for index in self._positions.get(module, []):
+            self._reschedule(index, 0)
+
+    def _dispatch(self, event):
+        """Send `event` to the modules that handle it.
+
+        Parameters:
+            event (str): The name of the event that was fired.
+        """
+        modules = list(self._broadcast_handlers)
+        for length in self._prefix_lengths:
+            for module in self._handlers.get(event[:length], []):
+                if module not in modules:
+                    modules.append(module)
+
+        for module in modules:
+            module.handle_event(event)
+
+    def _render_module(self, module, buf):
+        """Render `module` by appending its fragments to `buf`.
+
+        Parameters:
+            module (Module): The module to render.
+            buf (bytearray): The buffer to append the module's fragments to.
+
+        Returns:
+            bytes: The encoded output of the module.
+        """
+        start = len(buf)
+        for fragment in module.render():
+            buf.extend(fragment)
+        return bytes(buf[start:])
+
     def _run_modules(self, readables):
         """Run the modules ready for updating.
 
         Parameters:
-            readables (list): A list of readables returned by `select` that are
-                ready for reading.
+            readables (list): A list of readables returned by `self._wait` that
+                are ready for reading.
         """
         LOGGER.debug('Updating modules')
 
         now = time.time()
-        for module in self._modules:
-            time_delta = now - module.last_update
-
-            module_readables = [
-                readable for readable in module.readables
-                if readable in readables]
-
-            if module_readables:
-                LOGGER.info('Updating readable module "{}"'.format(module))
-                value = module.output()
-                module.last_update = now
-            elif not module_readables and module.wait_time and (
-                    module.last_update == 0 or time_delta > module.wait_time):
-                LOGGER.info('Updating time based module "{}"'.format(module))
-                value = module.output()
-                module.last_update = now
-            elif module.cache is None:
-                LOGGER.info('Using blank value for module "{}"'.format(module))
-                # If the module waits on a readable and we've not had the first
-                # read yet, we just return an empty string
-                value = ''
-                module.last_update = now
-            else:
-                LOGGER.info('Using cached value for module "{}"'.format(module))
-                value = module.cache
 
-            LOGGER.debug('Sending "{}" to lemonbar'.format(value))
-            self._lemonbar.stdin.write(value)
+        ready = set()
+        for readable in readables:
+            ready.update(self._readable_positions.get(readable, []))
+
+        while self._schedule and self._schedule[0][0] <= now:
+            when, index = heapq.heappop(self._schedule)
+            if when == self._next_update[index]:
+                ready.add(index)
+
+        pending = []
+        for index in sorted(ready):
+            if self._modules[index] not in pending:
+                pending.append(self._modules[index])
+
+        # Modules are independent of each other, so if several need updating
+        # render them concurrently, a slow module then only delays the redraw
+        # by its own run time. Each one renders into a buffer of its own, which
+        # is then copied into the line. A single module is rendered straight
+        # into the line below.
+        rendered = {}
+        if len(pending) > 1:
+            futures = [
+                (module, self._pool.submit(
+                    self._render_module, module, bytearray()))
+                for module in pending]
+            rendered = {module: future.result() for module, future in futures}
+
+        buf = bytearray()
+        for index, module in enumerate(self._modules):
+            if index not in ready:
+                buf.extend(self._parts[index])
+                continue
+
+            LOGGER.info('Updating module "%s"', module)
+            if module in rendered:
+                value = rendered[module]
+                buf.extend(value)
+            else:  # Render straight into the line being built
+                value = self._render_module(module, buf)
+                rendered[module] = value
+
+            module.last_update = now
             module.cache = value
+            self._parts[index] = value
 
-        self._lemonbar.stdin.write('\n')
-        self._lemonbar.stdin.flush()
+            if module.wait_time:
+                self._reschedule(index, now + module.wait_time)
+            else:
+                self._next_update[index] = None
+
+        buf.append(0x0A)  # Newline
 
-    def _calculate_wait(self, last_loop_time, interrupted):
-        min_wait_time = min([
-            module.wait_time for module in self._modules if module.wait_time])
+        # Don't make lemonbar redraw if nothing has actually changed
+        if buf == self._last_line:
+            LOGGER.debug('Output unchanged, not sending to lemonbar')
+            return
 
-        LOGGER.debug('Minimum wait time is {}'.format(min_wait_time))
+        LOGGER.debug('Sending "%s" to lemonbar', buf)
+        self._lemonbar.stdin.write(buf)
+        self._lemonbar.stdin.flush()
+        self._last_line = buf
 
-        invalidated = any([
-            module.last_update == 0 for module in self._modules])
+    def _calculate_wait(self):
+        """Calculate how long to wait until the next module needs updating.
 
-        if invalidated:
-            wait_time = 0
-        elif interrupted:
-            wait_time = min_wait_time - last_loop_time
+        Returns:
+            float: The number of seconds to wait.
+        """
+        # Drop any stale entries so the head of the heap is accurate
+        while self._schedule:
+            when, index = self._schedule[0]
+            if when == self._next_update[index]:
+                break
+            heapq.heappop(self._schedule)
+
+        if self._schedule:
+            wait_time = max(0, self._schedule[0][0] - time.time())
         else:
-            wait_time = min_wait_time
-
-        wait_time = max(0, wait_time)
+            wait_time = 86400  # Nothing is time based, wait on readables
 
-        LOGGER.debug('Wait time is {}'.format(wait_time))
+        LOGGER.debug('Wait time is %s', wait_time)
         return wait_time
 
     def loop(self):
         """The main program loop.
 
-        Invoke this method when you want to start updating the bar.
+        Invoke this method when you want to start updating the bar. When run
+        from the main thread, it returns when the process receives `SIGTERM`.
         """
         event_pipe = self._lemonbar.stdout
 
-        start_time = time.time()
-        end_time = start_time
-        interrupted = False  # Whether the loop was interrupted by a readable
-
-        # TODO: Determine whether this should be inside the loop. For my use,
-        # it's fine here, but do people want to swap out readables at will?
-        rlist = []
-        for module in self._modules:
-            rlist.extend(module.readables)
-        rlist.append(event_pipe)  # Wait for events coming from lemonbar too
-
-        while True:
-            last_loop_time = end_time - start_time
-            start_time = time.time()
-
-            wait_time = self._calculate_wait(last_loop_time, interrupted)
-
-            readables = self._wait(rlist, wait_time)
-            interrupted = len(readables) > 0
-
-            self._run_modules(readables)
-
-            if event_pipe in readables:
-                event = event_pipe.readline().rstrip()
-                LOGGER.info('Handling event "{}"'.format(event))
-                for module in self._modules:
-                    module.handle_event(event)
-
-            end_time = time.time()
+        # Signal handlers can only be installed from the main thread
+        handle_signals = threading.current_thread() is threading.main_thread()
+        if handle_signals:
+            previous_handler = signal.signal(
+                signal.SIGTERM, self._handle_signal)
+
+        try:
+            while True:
+                wait_time = self._calculate_wait()
+
+                readables = self._wait(wait_time)
+
+                if self._wake_r in readables:
+                    LOGGER.info('Received signal, shutting down')
+                    while True:  # Drain the pipe
+                        try:
+                            os.read(self._wake_r, 512)
+                        except BlockingIOError:
+                            break
+                    break
+
+                self._run_modules(readables)
+
+                if event_pipe in readables:
+                    event = event_pipe.readline().decode('utf-8').rstrip()
+                    LOGGER.info('Handling event "%s"', event)
+                    self._dispatch(event)
+        finally:
+            if handle_signals:
+                signal.signal(signal.SIGTERM, previous_handler)